@@ -45,7 +45,10 @@ OUTPUT_DIR.mkdir(exist_ok=True)
 # GPT模型配置
 GPT_CONFIG = {
     "model": "gpt-5",
-    "temperature": 1
+    "temperature": 1,
+    "max_concurrent_requests": 8,   # 并发GPT请求数上限
+    "requests_per_minute": 60,      # 每分钟请求数配额（RPM）
+    "tokens_per_minute": 150000     # 每分钟token配额（TPM）
 }
 
 # Whisper模型配置
@@ -58,7 +61,7 @@ WHISPER_CONFIG = {
 AUDIO_CONFIG = {
     "default_model": WHISPER_CONFIG["default_model"],
     "default_language": WHISPER_CONFIG["default_language"],
-    "supported_formats": [".mp3", ".wav", ".m4a", ".flac"]
+    "supported_formats": [".wav", ".mp3", ".m4a", ".flac"]
 }
 
 # 视频处理配置
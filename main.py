@@ -7,18 +7,20 @@
 
 import sys
 import os
+import functools
 import logging
 import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
 # 添加项目根目录到路径
 sys.path.append(str(Path(__file__).parent))
 
-# 导入工具模块
-from tools.audio_downloader import AudioDownloader
-from tools.subtitle_generator import SubtitleGenerator
-from tools.note_generator import NoteGenerator
+# 工具模块在首次使用时才导入（见下方get_*函数），
+# 避免`python main.py --help`冷启动时加载全部重量级依赖
 
 # 导入配置
 from config.settings import OPENAI_API_KEY, WHISPER_CONFIG, OUTPUT_DIR, LOGGING_CONFIG, DEFAULT_VIDEO_PATH, DEFAULT_VIDEO_TITLE
@@ -33,7 +35,138 @@ def setup_logging():
         ]
     )
 
-def process_video_to_notes(video_path: str, 
+# 日志分隔横幅，预先构建一次
+_BANNER = "=" * 50
+
+# 流水线中每个音频块的时长（秒）
+AUDIO_CHUNK_SECONDS = 300
+
+@functools.lru_cache(maxsize=1)
+def get_audio_downloader() -> "AudioDownloader":
+    """获取共享的音频下载器实例"""
+    from tools.audio_downloader import AudioDownloader
+    return AudioDownloader()
+
+@functools.lru_cache(maxsize=4)
+def get_subtitle_generator(model_size: str) -> "SubtitleGenerator":
+    """
+    获取字幕生成器单例（按模型大小缓存）
+
+    Whisper模型加载需要数秒并占用GPU显存，批量处理多个视频时
+    复用同一实例避免重复加载
+    """
+    from tools.subtitle_generator import SubtitleGenerator
+    return SubtitleGenerator(model_size=model_size)
+
+@functools.lru_cache(maxsize=4)
+def get_note_generator(api_key: Optional[str]) -> "NoteGenerator":
+    """获取笔记生成器单例（按API密钥缓存）"""
+    from tools.note_generator import NoteGenerator
+    return NoteGenerator(api_key=api_key)
+
+# 转录缓存目录
+TRANSCRIPTION_CACHE_DIR = OUTPUT_DIR / ".cache"
+
+def _audio_fingerprint(audio_path: str) -> str:
+    """
+    计算音频文件的快速指纹
+
+    哈希文件大小和首尾各1MB内容，不读取整个文件，
+    足以区分不同音频且开销可忽略
+    """
+    import hashlib
+
+    one_mb = 1024 * 1024
+    size = os.path.getsize(audio_path)
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(audio_path, "rb") as f:
+        h.update(f.read(one_mb))
+        if size > 2 * one_mb:
+            f.seek(-one_mb, os.SEEK_END)
+            h.update(f.read(one_mb))
+
+    return h.hexdigest()
+
+def _transcription_cache_path(audio_path: str, model_size: str) -> Path:
+    """生成转录缓存文件路径，key为音频指纹+模型大小+语言"""
+    fingerprint = _audio_fingerprint(audio_path)
+    language = WHISPER_CONFIG["default_language"]
+    return TRANSCRIPTION_CACHE_DIR / f"{fingerprint}-{model_size}-{language}.json"
+
+def _produce_audio_chunks(audio_downloader: "AudioDownloader",
+                          video_path: str,
+                          temp_dir: Path,
+                          chunk_queue: queue.Queue,
+                          producer_state: dict,
+                          model_size: str):
+    """
+    生产者线程：下载/提取音频并切分为块，逐块放入队列
+
+    切分出的音频块路径依次放入chunk_queue，结束时放入None作为结束标记；
+    下载结果和错误通过producer_state传回主线程。
+    如果命中转录缓存，直接传回缓存结果并跳过切分
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        # 判断是URL还是本地文件
+        if video_path.startswith(('http://', 'https://')):
+            logger.info("检测到URL，开始下载音频...")
+            audio_path, extracted_title = audio_downloader.download_audio_from_url(video_path, str(temp_dir))
+        else:
+            logger.info("检测到本地文件，开始提取音频...")
+            audio_path, extracted_title = audio_downloader.extract_audio_from_video(video_path, str(temp_dir))
+
+        producer_state["audio_path"] = audio_path
+        producer_state["title"] = extracted_title
+
+        # 检查转录缓存：同一音频+模型+语言的转录结果是确定的，可直接复用
+        import orjson
+        cache_path = _transcription_cache_path(audio_path, model_size)
+        producer_state["cache_path"] = cache_path
+        if cache_path.exists():
+            logger.info("命中转录缓存: %s", cache_path)
+            producer_state["cached_transcription"] = orjson.loads(cache_path.read_bytes())
+            return
+
+        # 切分为固定时长的块，供转录消费者流水线处理
+        chunks = audio_downloader.split_audio(audio_path, str(temp_dir / "chunks"), AUDIO_CHUNK_SECONDS)
+        for chunk in chunks:
+            chunk_queue.put(chunk)
+
+    except Exception as e:
+        producer_state["error"] = e
+    finally:
+        chunk_queue.put(None)
+
+def _merge_transcriptions(chunk_results: list, chunk_seconds: int) -> dict:
+    """合并各音频块的转录结果，按块序号对段落时间戳加偏移"""
+    segments = []
+    full_text_parts = []
+    duration = 0
+    confidence_sum = 0.0
+
+    for index, result in enumerate(chunk_results):
+        offset = index * chunk_seconds
+        for segment in result.get("segments", []):
+            merged_segment = dict(segment)
+            merged_segment["start"] = segment.get("start", 0) + offset
+            merged_segment["end"] = segment.get("end", 0) + offset
+            segments.append(merged_segment)
+        full_text_parts.append(result.get("full_text", ""))
+        duration += result.get("duration", 0)
+        confidence_sum += result.get("_confidence_sum", 0)
+
+    return {
+        "full_text": "".join(full_text_parts),
+        "segments": segments,
+        "language": chunk_results[0].get("language", "zh") if chunk_results else "zh",
+        "duration": duration,
+        "_confidence_sum": confidence_sum
+    }
+
+def process_video_to_notes(video_path: str,
                           output_dir: str = None,
                           model_size: str = None,
                           api_key: Optional[str] = None,
@@ -60,9 +193,14 @@ def process_video_to_notes(video_path: str,
         if output_dir is None:
             output_dir = OUTPUT_DIR
         
+        # 一次性创建所有输出目录，后续环节不再重复mkdir
         output_path = Path(output_dir)
-        output_path.mkdir(parents=True, exist_ok=True)
-        
+        temp_dir = output_path / "temp"
+        subtitles_dir = output_path / "subtitles"
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        if save_subtitles:
+            subtitles_dir.mkdir(exist_ok=True)
+
         # 如果没有提供标题，从文件名提取
         if video_title is None:
             video_title = Path(video_path).stem
@@ -73,66 +211,96 @@ def process_video_to_notes(video_path: str,
         if api_key is None:
             api_key = OPENAI_API_KEY
         
-        logger.info(f"开始处理视频: {video_path}")
-        logger.info(f"视频标题: {video_title}")
-        logger.info(f"输出目录: {output_path}")
-        
-        # 步骤1: 音频下载/提取
-        logger.info("=" * 50)
-        logger.info("步骤1: 音频下载/提取")
-        logger.info("=" * 50)
-        
-        audio_downloader = AudioDownloader()
-        
-        # 判断是URL还是本地文件
-        if video_path.startswith(('http://', 'https://')):
-            logger.info("检测到URL，开始下载音频...")
-            audio_path, extracted_title = audio_downloader.download_audio_from_url(video_path, str(output_path / "temp"))
-        else:
-            logger.info("检测到本地文件，开始提取音频...")
-            audio_path, extracted_title = audio_downloader.extract_audio_from_video(video_path, str(output_path / "temp"))
+        logger.info("开始处理视频: %s", video_path)
+        logger.info("视频标题: %s", video_title)
+        logger.info("输出目录: %s", output_path)
         
+        # 步骤1+2: 音频下载/提取与转录流水线
+        # 生产者线程负责下载和切分音频块，主线程边加载模型边消费转录，
+        # 让下载、模型加载和转录在时间上重叠
+        logger.info(_BANNER)
+        logger.info("步骤1+2: 音频下载/提取 + 音频转字幕（流水线）")
+        logger.info(_BANNER)
+
+        audio_downloader = get_audio_downloader()
+        chunk_queue = queue.Queue()
+        producer_state = {}
+
+        producer = threading.Thread(
+            target=_produce_audio_chunks,
+            args=(audio_downloader, video_path, temp_dir, chunk_queue, producer_state, model_size),
+            daemon=True
+        )
+        producer.start()
+
+        # 模型加载与下载并行进行（重复调用时直接复用已加载的模型）
+        subtitle_generator = get_subtitle_generator(model_size)
+
+        # 消费音频块：块一旦就绪立即转录
+        # 把上一块结尾的文本作为下一块的上下文提示，减少固定时长切点造成的断句损失
+        chunk_results = []
+        context_prompt = None
+        while True:
+            chunk_path = chunk_queue.get()
+            if chunk_path is None:
+                break
+            result = subtitle_generator.transcribe_audio(chunk_path, context_prompt=context_prompt)
+            chunk_results.append(result)
+            tail_segments = result.get("segments", [])[-2:]
+            context_prompt = "".join(s.get("text", "") for s in tail_segments)[-200:] or None
+
+        producer.join()
+        if "error" in producer_state:
+            raise producer_state["error"]
+
+        audio_path = producer_state["audio_path"]
+        extracted_title = producer_state["title"]
+
         # 如果没有提供标题，使用从视频中提取的标题
         if not video_title or video_title == DEFAULT_VIDEO_TITLE:
             video_title = extracted_title
-            logger.info(f"使用从视频中提取的标题: {video_title}")
-        
+            logger.info("使用从视频中提取的标题: %s", video_title)
+
         # 获取音频信息
         audio_info = audio_downloader.get_audio_info(audio_path)
-        logger.info(f"音频信息: {audio_info}")
-        
-        # 步骤2: 音频转字幕
-        logger.info("=" * 50)
-        logger.info("步骤2: 音频转字幕")
-        logger.info("=" * 50)
-        
-        subtitle_generator = SubtitleGenerator(model_size=model_size)
-        transcription = subtitle_generator.transcribe_audio(audio_path)
-        
+        logger.info("音频信息: %s", audio_info)
+
+        # 命中缓存时直接使用缓存的转录结果，否则合并各块结果并写入缓存
+        if "cached_transcription" in producer_state:
+            transcription = producer_state["cached_transcription"]
+        else:
+            transcription = _merge_transcriptions(chunk_results, AUDIO_CHUNK_SECONDS)
+
+            import orjson
+            cache_path = producer_state.get("cache_path")
+            if cache_path is not None:
+                TRANSCRIPTION_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                cache_path.write_bytes(orjson.dumps(transcription))
+                logger.info("转录结果已缓存: %s", cache_path)
+
         # 获取转录统计信息
         transcription_stats = subtitle_generator.get_transcription_stats(transcription)
-        logger.info(f"转录统计: {transcription_stats}")
+        logger.info("转录统计: %s", transcription_stats)
         
         # 保存字幕文件
         if save_subtitles:
             logger.info("保存字幕文件...")
-            subtitles_dir = output_path / "subtitles"
-            subtitles_dir.mkdir(exist_ok=True)
-            
             subtitle_generator.save_subtitle_file(transcription, str(subtitles_dir / "subtitle.srt"), "srt")
             subtitle_generator.save_subtitle_file(transcription, str(subtitles_dir / "subtitle.vtt"), "vtt")
             subtitle_generator.save_subtitle_file(transcription, str(subtitles_dir / "subtitle.txt"), "txt")
         
         # 步骤3: 生成学习笔记
-        logger.info("=" * 50)
+        logger.info(_BANNER)
         logger.info("步骤3: 生成学习笔记")
-        logger.info("=" * 50)
+        logger.info(_BANNER)
         
-        note_generator = NoteGenerator(api_key=api_key)
+        note_generator = get_note_generator(api_key)
+        # 流式生成：最终笔记边生成边写入目标Markdown文件
         notes = note_generator.generate_learning_notes(
             transcription=transcription,
             video_title=video_title,
-            output_format="markdown"
+            output_format="markdown",
+            stream_to=str(note_generator.notes_file_path(str(output_path), video_title))
         )
         
         # 保存笔记
@@ -143,14 +311,23 @@ def process_video_to_notes(video_path: str,
             video_title=video_title
         )
         
-        # 保存原始数据
-        import json
-        with open(output_path / "transcription_data.json", "w", encoding="utf-8") as f:
-            json.dump(transcription, f, ensure_ascii=False, indent=2)
+        # 保存原始数据 - 逐行写JSONL，段落只保留起止时间和文本
+        import orjson
+        with open(output_path / "transcription.jsonl", "wb") as f:
+            f.write(orjson.dumps({
+                "duration": transcription.get("duration", 0),
+                "language": transcription.get("language", "zh")
+            }) + b"\n")
+            for segment in transcription.get("segments", []):
+                f.write(orjson.dumps({
+                    "s": segment.get("start", 0),
+                    "e": segment.get("end", 0),
+                    "t": segment.get("text", "")
+                }) + b"\n")
         
-        logger.info("=" * 50)
+        logger.info(_BANNER)
         logger.info("处理完成！")
-        logger.info("=" * 50)
+        logger.info(_BANNER)
         
         return {
             "success": True,
@@ -169,12 +346,33 @@ def process_video_to_notes(video_path: str,
         }
         
     except Exception as e:
-        logger.error(f"处理失败: {e}")
+        logger.error("处理失败: %s", e)
         return {
             "success": False,
             "error": str(e)
         }
 
+def process_many(video_paths: list, **kwargs) -> list:
+    """
+    批量处理多个视频
+
+    复用同一组生成器实例（模型只加载一次），用线程池让
+    一个视频的下载/GPT调用与另一个视频的转录在时间上重叠
+
+    Args:
+        video_paths: 视频文件路径或URL列表
+        **kwargs: 透传给process_video_to_notes的参数
+
+    Returns:
+        list: 每个视频的处理结果
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(process_video_to_notes, video_path, **kwargs)
+            for video_path in video_paths
+        ]
+        return [future.result() for future in futures]
+
 def main():
     """主函数"""
     parser = argparse.ArgumentParser(description="字幕转学习笔记工具")
@@ -1,14 +1,25 @@
 """
 工具模块包
 包含音频下载、字幕生成和笔记生成三个核心工具
-"""
 
-from .audio_downloader import AudioDownloader
-from .subtitle_generator import SubtitleGenerator
-from .note_generator import NoteGenerator
+工具类按需延迟导入（PEP 562），避免`import tools`时
+一次性拉起yt-dlp、faster-whisper、openai等重量级依赖
+"""
 
 __all__ = [
     'AudioDownloader',
-    'SubtitleGenerator', 
+    'SubtitleGenerator',
     'NoteGenerator'
 ]
+
+def __getattr__(name):
+    if name == 'AudioDownloader':
+        from .audio_downloader import AudioDownloader
+        return AudioDownloader
+    if name == 'SubtitleGenerator':
+        from .subtitle_generator import SubtitleGenerator
+        return SubtitleGenerator
+    if name == 'NoteGenerator':
+        from .note_generator import NoteGenerator
+        return NoteGenerator
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -5,9 +5,9 @@
 
 import os
 import logging
+import subprocess
 from pathlib import Path
 from typing import Optional
-import yt_dlp
 
 class AudioDownloader:
     """音频下载器"""
@@ -27,41 +27,47 @@ class AudioDownloader:
             tuple: (音频文件路径, 视频标题)
         """
         try:
-            # 创建输出目录
+            import yt_dlp
+
+            # 创建输出目录（调用方已创建时跳过）
             output_path = Path(output_dir)
-            output_path.mkdir(parents=True, exist_ok=True)
-            
-            # 配置yt-dlp选项
+            if not output_path.is_dir():
+                output_path.mkdir(parents=True, exist_ok=True)
+
+            # 通过下载钩子捕获yt-dlp实际写出的文件路径，
+            # 避免根据标题猜测文件名（yt-dlp会对标题做清理，猜测容易失配）
+            downloaded = {}
+
+            def _capture_path(d):
+                if d.get('status') == 'finished':
+                    downloaded['path'] = d.get('info_dict', {}).get('filepath') or d.get('filename')
+
+            # 配置yt-dlp选项 - 直接下载源音频流，不做MP3转码
             ydl_opts = {
                 'format': 'bestaudio/best',
                 'outtmpl': str(output_path / '%(title)s.%(ext)s'),
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
+                'progress_hooks': [_capture_path],
                 'quiet': False,
                 'no_warnings': False
             }
-            
-            self.logger.info(f"开始下载音频: {url}")
-            
+
+            self.logger.info("开始下载音频: %s", url)
+
             # 下载音频
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 info = ydl.extract_info(url, download=True)
                 title = info.get('title', 'video')
-                
-            # 查找下载的音频文件
-            audio_files = list(output_path.glob(f"{title}*.mp3"))
-            if audio_files:
-                audio_path = str(audio_files[0])
-                self.logger.info(f"音频下载完成: {audio_path}")
-                return audio_path, title
-            else:
-                raise Exception("未找到下载的音频文件")
-                
+                source_path = downloaded.get('path') or ydl.prepare_filename(info)
+
+            # 一次ffmpeg转换为16kHz单声道WAV（Whisper的输入格式），跳过MP3编码
+            audio_path = str(output_path / f"{Path(source_path).stem}.wav")
+            self._convert_to_wav(source_path, audio_path)
+
+            self.logger.info("音频下载完成: %s", audio_path)
+            return audio_path, title
+
         except Exception as e:
-            self.logger.error(f"音频下载失败: {e}")
+            self.logger.error("音频下载失败: %s", e)
             raise
     
     def extract_audio_from_video(self, video_path: str, output_dir: str = "temp") -> tuple:
@@ -79,63 +85,170 @@ class AudioDownloader:
             if not os.path.exists(video_path):
                 raise FileNotFoundError(f"视频文件不存在: {video_path}")
             
-            # 创建输出目录
+            # 创建输出目录（调用方已创建时跳过）
             output_path = Path(output_dir)
-            output_path.mkdir(parents=True, exist_ok=True)
+            if not output_path.is_dir():
+                output_path.mkdir(parents=True, exist_ok=True)
             
             # 生成输出文件名
             video_name = Path(video_path).stem
-            audio_path = str(output_path / f"{video_name}.mp3")
-            
-            self.logger.info(f"开始提取音频: {video_path}")
-            
-            # 使用yt-dlp提取音频
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': audio_path,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'quiet': False,
-                'no_warnings': False
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([video_path])
-            
-            self.logger.info(f"音频提取完成: {audio_path}")
+            audio_path = str(output_path / f"{video_name}.wav")
+
+            self.logger.info("开始提取音频: %s", video_path)
+
+            # 本地文件直接用ffmpeg提取音频，一次转换，无MP3编码
+            self._convert_to_wav(video_path, audio_path)
+
+            self.logger.info("音频提取完成: %s", audio_path)
             return audio_path, video_name
-            
+
+        except Exception as e:
+            self.logger.error("音频提取失败: %s", e)
+            raise
+
+    def split_audio(self, audio_path: str, output_dir: str, chunk_seconds: int = 300) -> list:
+        """
+        将音频按固定时长切分为多个WAV块
+
+        使用流拷贝切分，不重新编码，用于给转录环节提供可流水线处理的音频块
+
+        Args:
+            audio_path: 音频文件路径
+            output_dir: 音频块输出目录
+            chunk_seconds: 每块的时长（秒）
+
+        Returns:
+            list: 按顺序排列的音频块路径
+        """
+        try:
+            output_path = Path(output_dir)
+            output_path.mkdir(parents=True, exist_ok=True)
+
+            # 视频标题中的"%"会破坏ffmpeg的%04d序号占位符，需转义
+            stem = Path(audio_path).stem
+            pattern = str(output_path / f"{stem.replace('%', '%%')}_%04d.wav")
+
+            result = subprocess.run(
+                [
+                    "ffmpeg", "-y", "-i", audio_path,
+                    "-f", "segment", "-segment_time", str(chunk_seconds),
+                    "-c", "copy",
+                    pattern
+                ],
+                capture_output=True,
+                text=True
+            )
+            if result.returncode != 0:
+                raise Exception(f"ffmpeg音频切分失败: {result.stderr.strip().splitlines()[-1] if result.stderr else result.returncode}")
+
+            # 输出文件名是确定的，按序号逐个枚举到首个缺失的序号为止；
+            # 不能用glob——标题中的"["、"?"、"*"会被当作通配符导致漏配
+            chunks = []
+            index = 0
+            while True:
+                chunk = output_path / f"{stem}_{index:04d}.wav"
+                if not chunk.exists():
+                    break
+                chunks.append(str(chunk))
+                index += 1
+
+            if not chunks:
+                raise Exception(f"ffmpeg音频切分未产生任何音频块: {audio_path}")
+
+            self.logger.info("音频切分完成，共 %s 块", len(chunks))
+            return chunks
+
         except Exception as e:
-            self.logger.error(f"音频提取失败: {e}")
+            self.logger.error("音频切分失败: %s", e)
             raise
+
+    def _convert_to_wav(self, source_path: str, output_path: str):
+        """用ffmpeg将音视频文件转换为16kHz单声道WAV"""
+        result = subprocess.run(
+            [
+                "ffmpeg", "-y", "-i", source_path,
+                "-vn", "-ac", "1", "-ar", "16000",
+                "-c:a", "pcm_s16le",
+                output_path
+            ],
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            raise Exception(f"ffmpeg音频转换失败: {result.stderr.strip().splitlines()[-1] if result.stderr else result.returncode}")
     
     def get_audio_info(self, audio_path: str) -> dict:
         """
         获取音频文件信息
-        
+
+        只读取文件头部的元数据，不解码音频数据本身
+
         Args:
             audio_path: 音频文件路径
-            
+
         Returns:
             dict: 音频信息
         """
         try:
+            # 优先使用soundfile读取文件头信息（不解码音频数据）
+            try:
+                import soundfile
+
+                info = soundfile.info(audio_path)
+                return {
+                    "path": audio_path,
+                    "duration": info.frames / info.samplerate,
+                    "sample_rate": info.samplerate,
+                    "channels": info.channels
+                }
+            except Exception:
+                pass
+
+            # soundfile不支持的格式（如部分MP3）使用ffprobe读取元数据
+            try:
+                return self._probe_audio_info(audio_path)
+            except Exception:
+                pass
+
+            # 最后的兜底方案：librosa完整解码（很慢，仅在前两种方式都失败时使用）
             import librosa
-            
-            # 加载音频文件
+
             y, sr = librosa.load(audio_path)
             duration = librosa.get_duration(y=y, sr=sr)
-            
+
             return {
                 "path": audio_path,
                 "duration": duration,
                 "sample_rate": sr,
                 "channels": 1 if len(y.shape) == 1 else 2
             }
-            
+
         except Exception as e:
-            self.logger.error(f"获取音频信息失败: {e}")
+            self.logger.error("获取音频信息失败: %s", e)
             return {"path": audio_path, "error": str(e)}
+
+    def _probe_audio_info(self, audio_path: str) -> dict:
+        """使用ffprobe读取音频元数据"""
+        import json
+        import subprocess
+
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "error",
+                "-show_entries", "stream=sample_rate,channels:format=duration",
+                "-of", "json", audio_path
+            ],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+
+        probe = json.loads(result.stdout)
+        stream = probe.get("streams", [{}])[0]
+
+        return {
+            "path": audio_path,
+            "duration": float(probe.get("format", {}).get("duration", 0)),
+            "sample_rate": int(stream.get("sample_rate", 0)),
+            "channels": int(stream.get("channels", 0))
+        }
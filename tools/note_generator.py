@@ -3,14 +3,76 @@ LLM生成笔记工具
 负责将字幕转换为高质量的Markdown学习笔记
 """
 
-import openai
+import asyncio
+import random
+import time
 import logging
 from typing import Dict, List, Optional
-import json
 import re
 from pathlib import Path
 from config.settings import AI_CONFIG, GPT_CONFIG
 
+# 系统角色设定，所有GPT调用共用
+SYSTEM_PROMPT = "你是一位专业的历史学者和教育专家，擅长将历史视频的字幕内容转化为通俗易懂、高质量的学习笔记。请使用简单明了的语言，避免过于学术化的、晦涩难懂的和自己编造的词汇。"
+
+# 切分字幕的时间窗口（秒），每个窗口对应一次独立的GPT调用
+CHUNK_WINDOW_SECONDS = 600
+
+# 限流失败后的最大重试次数
+MAX_RETRY_ATTEMPTS = 6
+
+# 预编译的响应解析正则：一次扫描同时提取章节标题、关键词和地图建议
+_NOTES_SCAN_RE = re.compile(
+    r'(?P<section>^#+[^\n]*)'          # 章节标题
+    r'|\*\*(?P<keyword>.*?)\*\*'       # 关键词（加粗内容）
+    r'|\[(?P<map_title>.*?)\] - "(?P<map_keyword>.*?)"',  # 地图搜索建议
+    re.MULTILINE
+)
+
+# 文件名中需要替换的特殊字符
+_UNSAFE_FILENAME_RE = re.compile(r'[<>:"/\\|?*]')
+
+class _RateLimiter:
+    """
+    令牌桶限流器
+
+    按每分钟请求数（RPM）和token数（TPM）配额匀速放行GPT请求，
+    避免并发调用瞬间冲破OpenAI配额触发429
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int):
+        """等待直到配额允许发出一次消耗estimated_tokens的请求"""
+        # 估算值超过桶容量时按容量封顶，否则条件永远无法满足、调用方会无限等待
+        # （此时令牌桶退化为整分钟配额的匀速放行）
+        estimated_tokens = min(estimated_tokens, self.token_capacity)
+
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                elapsed = now - self.updated_at
+                self.updated_at = now
+
+                # 按时间流逝补充配额
+                self.requests = min(self.request_capacity,
+                                    self.requests + elapsed * self.request_capacity / 60)
+                self.tokens = min(self.token_capacity,
+                                  self.tokens + elapsed * self.token_capacity / 60)
+
+                if self.requests >= 1 and self.tokens >= estimated_tokens:
+                    self.requests -= 1
+                    self.tokens -= estimated_tokens
+                    return
+
+            await asyncio.sleep(0.5)
+
 class NoteGenerator:
     """笔记生成器"""
     
@@ -22,31 +84,31 @@ class NoteGenerator:
             api_key: OpenAI API密钥
         """
         self.api_key = api_key
-        if api_key:
-            openai.api_key = api_key
         self.logger = logging.getLogger(__name__)
     
-    def generate_learning_notes(self, 
-                               transcription: Dict, 
+    def generate_learning_notes(self,
+                               transcription: Dict,
                                video_title: str = "",
-                               output_format: str = "markdown") -> Dict:
+                               output_format: str = "markdown",
+                               stream_to: Optional[str] = None) -> Dict:
         """
         基于字幕生成学习笔记
-        
+
         Args:
             transcription: 音频转录结果
             video_title: 视频标题
             output_format: 输出格式 ("markdown" 或 "json")
-            
+            stream_to: 可选的文件路径，最终笔记将边生成边写入该文件
+
         Returns:
             Dict: 学习笔记
         """
         try:
             # 1. 预处理字幕内容
             processed_content = self._preprocess_subtitle_content(transcription)
-            
+
             # 2. 生成学习笔记
-            notes = self._generate_notes_from_subtitle(processed_content, video_title)
+            notes = self._generate_notes_from_subtitle(processed_content, video_title, stream_to)
             
             # 3. 根据格式输出
             if output_format == "markdown":
@@ -65,52 +127,105 @@ class NoteGenerator:
                 return notes
                 
         except Exception as e:
-            self.logger.error(f"学习笔记生成失败: {e}")
+            self.logger.error("学习笔记生成失败: %s", e)
             raise
     
     def _preprocess_subtitle_content(self, transcription: Dict) -> Dict:
         """预处理字幕内容"""
         try:
-            # 提取完整文本
-            full_text = transcription.get("full_text", "")
-            segments = transcription.get("segments", [])
-            
-            # 按时间轴组织内容
-            timeline_content = []
-            for segment in segments:
-                timeline_content.append({
-                    "timestamp": segment.get("start", 0),
-                    "text": segment.get("text", ""),
-                    "confidence": segment.get("confidence", 0)
-                })
-            
+            # 直接复用原始段落，不再重建一份平行的时间轴字典列表
             return {
-                "full_text": full_text,
-                "timeline_content": timeline_content,
-                "original_segments": segments
+                "full_text": transcription.get("full_text", ""),
+                "original_segments": transcription.get("segments", [])
             }
-            
+
         except Exception as e:
-            self.logger.error(f"字幕内容预处理失败: {e}")
+            self.logger.error("字幕内容预处理失败: %s", e)
             raise
     
-    def _generate_notes_from_subtitle(self, processed_content: Dict, title: str) -> Dict:
+    def _generate_notes_from_subtitle(self, processed_content: Dict, title: str,
+                                      stream_to: Optional[str] = None) -> Dict:
         """从字幕生成学习笔记"""
         try:
-            # 构建增强的prompt
-            prompt = self._build_enhanced_prompt(processed_content, title)
-            
-            # 调用GPT生成笔记
-            response = self._call_gpt_for_notes(prompt, title)
-            
+            # 并发调用GPT生成笔记
+            response = asyncio.run(self._generate_notes_async(processed_content, title, stream_to))
+
             # 解析响应
             notes = self._parse_notes_response(response)
-            
+
             return notes
-            
+
         except Exception as e:
-            self.logger.error(f"笔记生成失败: {e}")
+            self.logger.error("笔记生成失败: %s", e)
             raise
+
+    async def _generate_notes_async(self, processed_content: Dict, title: str,
+                                    stream_to: Optional[str] = None) -> str:
+        """
+        并发生成学习笔记
+
+        短视频直接一次调用；长视频按时间窗口切分字幕，
+        并发生成各段笔记草稿后，再用一次调用合并为完整笔记。
+        指定stream_to时，最终笔记以流式方式边生成边写入该文件
+        """
+        import openai
+
+        client = openai.AsyncOpenAI(api_key=self.api_key)
+
+        # 并发上限与令牌桶限流，防止并发调用冲破OpenAI配额。
+        # 两者绑定当前事件循环，用局部变量逐层传递；存到self上会在
+        # 多线程批量处理（process_many共享同一实例）时被其他线程的
+        # 事件循环覆盖，导致等待者挂在已失效的对象上
+        semaphore = asyncio.Semaphore(GPT_CONFIG.get("max_concurrent_requests", 8))
+        rate_limiter = _RateLimiter(
+            GPT_CONFIG.get("requests_per_minute", 60),
+            GPT_CONFIG.get("tokens_per_minute", 150000)
+        )
+
+        chunks = self._chunk_segments(processed_content["original_segments"])
+
+        if len(chunks) <= 1:
+            prompt = self._build_enhanced_prompt(processed_content, title)
+            return await self._call_gpt_async(client, prompt, semaphore, rate_limiter,
+                                              stream_to=stream_to)
+
+        self.logger.info("字幕切分为 %s 段，并发生成笔记草稿", len(chunks))
+
+        # map阶段：每段字幕并发生成一份笔记草稿
+        section_prompts = [
+            self._build_section_prompt(chunk, title, index + 1, len(chunks))
+            for index, chunk in enumerate(chunks)
+        ]
+        drafts = await asyncio.gather(
+            *(self._call_gpt_async(client, prompt, semaphore, rate_limiter)
+              for prompt in section_prompts)
+        )
+
+        # reduce阶段：合并各段草稿为完整笔记
+        reduce_prompt = self._build_reduce_prompt(drafts, title)
+        return await self._call_gpt_async(client, reduce_prompt, semaphore, rate_limiter,
+                                          stream_to=stream_to)
+
+    def _chunk_segments(self, segments: List[Dict]) -> List[str]:
+        """按时间窗口把字幕段落切分为若干文本段"""
+        chunks = []
+        current = []
+        window_end = CHUNK_WINDOW_SECONDS
+
+        for segment in segments:
+            start = segment.get("start", 0)
+            if start >= window_end and current:
+                chunks.append("".join(current))
+                current = []
+                # 以触发切分的段落为新窗口的起点，而不是顺延一个窗口：
+                # 长静音后顺延会让后续每个段落各自成段，产生大量碎片调用
+                window_end = start + CHUNK_WINDOW_SECONDS
+            current.append(segment.get("text", ""))
+
+        if current:
+            chunks.append("".join(current))
+
+        return chunks
     
     def _build_enhanced_prompt(self, processed_content: Dict, title: str) -> str:
         """构建增强的prompt"""
@@ -177,94 +292,192 @@ class NoteGenerator:
         
         return prompt
     
-    def _call_gpt_for_notes(self, prompt: str, video_title: str = "历史学习笔记") -> str:
-        """调用GPT生成笔记"""
-        try:
-            # 使用新版本的OpenAI API
-            client = openai.OpenAI(api_key=self.api_key)
-            
-            response = client.chat.completions.create(
-                model=AI_CONFIG["default_model"],
-                messages=[
-                    {"role": "system", "content": "你是一位专业的历史学者和教育专家，擅长将历史视频的字幕内容转化为通俗易懂、高质量的学习笔记。请使用简单明了的语言，避免过于学术化的、晦涩难懂的和自己编造的词汇。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=GPT_CONFIG["temperature"]
-            )
-            
-            return response.choices[0].message.content
-            
-        except Exception as e:
-            print(f"GPT调用失败: {e}")
-            return response.choices[0].message.content
+    def _build_section_prompt(self, section_text: str, title: str, index: int, total: int) -> str:
+        """构建单段字幕的笔记草稿prompt"""
+        return f"""
+你是一位专业的历史学者和教育专家。以下是历史视频《{title}》字幕的第{index}/{total}段，请为这一段内容生成一份Markdown格式的学习笔记草稿。
+
+字幕内容：
+{section_text}
+
+要求：
+1. 使用Markdown格式，用二级及以下标题组织内容，不要使用一级标题
+2. 在首次出现时为西方人名地名使用括号标注英文，例如：马略(Marius)
+3. 对重要概念和关键词进行**加粗**处理
+4. 语言通俗易懂，避免学术化、晦涩难懂的词汇
+5. 只基于这一段字幕的内容，不要猜测其他段落的内容
+"""
+
+    def _build_reduce_prompt(self, drafts: List[str], title: str) -> str:
+        """构建合并各段草稿为完整笔记的prompt"""
+        drafts_text = "\n\n---\n\n".join(drafts)
+
+        return f"""
+你是一位专业的历史学者和教育专家。以下是历史视频《{title}》各段字幕分别生成的学习笔记草稿，请将它们合并为一份完整、连贯的Markdown学习笔记。
+
+各段笔记草稿：
+{drafts_text}
+
+请严格按照以下要求合并：
+
+## 标题要求
+请使用视频标题作为笔记的主标题，格式为：`# {title}`
+
+## 格式要求
+1. 使用Markdown格式
+2. 注重信息之间的逻辑联系，不要拘泥于时间顺序
+3. 保留人名地名的英文标注和重要概念的**加粗**处理
+4. **语言通俗化**：使用通俗易懂的语言，避免过于学术化、晦涩难懂的词汇和表达
+
+## 内容要求
+1. **地图优先**：在讲述具体历史事件之前，先提供相关地图搜索建议，帮助读者建立地理概念
+   - 格式：[地图标题] - 搜索关键词
+
+2. **知识扩展**：使用引用格式(>)适当加入相关知识/观点来帮助理解和深化内容
+
+3. **问答环节**：用斜体格式模拟学习者的思考、提问并模拟历史教授的回答
+   - 格式：*Q：问题内容*
+   - 格式：*A：回答内容*
+   - 问题和回答都要有深度、有启发性、有针对性，避免模板化
+
+4. **去重与衔接**：合并各段草稿中重复的内容，补充段落之间的逻辑衔接，使笔记成为一个整体
+
+请生成一份结构清晰、内容丰富、适合学习的Markdown笔记。特别注意，避免学术论文式的表达，尽量避免使用难懂的、学术化的或者由引号括起来的自己创造的新词汇
+"""
+
+    async def _call_gpt_async(self, client, prompt: str, semaphore: asyncio.Semaphore,
+                              rate_limiter: _RateLimiter,
+                              stream_to: Optional[str] = None) -> str:
+        """
+        异步调用GPT生成笔记（带并发上限、限流和退避重试）
+
+        指定stream_to时启用流式响应，增量内容边到达边写入该文件，
+        首字延迟取代全文生成时间成为可见延迟
+        """
+        import openai
+
+        # 粗略估算本次请求消耗的token数：prompt长度 + 输出预留
+        estimated_tokens = len(prompt) + 2000
+
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+
+        for attempt in range(MAX_RETRY_ATTEMPTS):
+            try:
+                async with semaphore:
+                    await rate_limiter.acquire(estimated_tokens)
+
+                    if stream_to is not None:
+                        stream = await client.chat.completions.create(
+                            model=AI_CONFIG["default_model"],
+                            messages=messages,
+                            temperature=GPT_CONFIG["temperature"],
+                            stream=True
+                        )
+
+                        parts = []
+                        with open(stream_to, "w", encoding="utf-8") as f:
+                            async for chunk in stream:
+                                delta = chunk.choices[0].delta.content or ""
+                                if delta:
+                                    f.write(delta)
+                                    parts.append(delta)
+                        return "".join(parts)
+
+                    response = await client.chat.completions.create(
+                        model=AI_CONFIG["default_model"],
+                        messages=messages,
+                        temperature=GPT_CONFIG["temperature"]
+                    )
+
+                    return response.choices[0].message.content
+
+            except openai.RateLimitError as e:
+                if attempt == MAX_RETRY_ATTEMPTS - 1:
+                    self.logger.error("GPT调用触发限流，已达最大重试次数: %s", e)
+                    raise
+                # 指数退避 + 随机抖动，最长等待30秒
+                wait_seconds = min(2 ** attempt + random.uniform(0, 1), 30)
+                self.logger.warning("GPT调用触发限流，%.1f秒后重试: %s", wait_seconds, e)
+                await asyncio.sleep(wait_seconds)
+
+            except Exception as e:
+                self.logger.error("GPT调用失败: %s", e)
+                raise
     
     def _parse_notes_response(self, response: str) -> Dict:
-        """解析GPT响应"""
+        """解析GPT响应，一次扫描提取章节标题、关键词和地图建议"""
         try:
+            sections = []
+            keywords = set()
+            maps = []
+
+            for match in _NOTES_SCAN_RE.finditer(response):
+                if match.lastgroup == "section":
+                    sections.append(match.group("section").strip())
+                elif match.lastgroup == "keyword":
+                    keywords.add(match.group("keyword"))
+                else:
+                    maps.append(f"{match.group('map_title')}: {match.group('map_keyword')}")
+
             return {
                 "content": response,
-                "sections": self._extract_sections(response),
-                "keywords": self._extract_keywords(response),
-                "maps": self._extract_map_suggestions(response)
+                "sections": sections,
+                "keywords": list(keywords),
+                "maps": maps
             }
         except Exception as e:
-            self.logger.error(f"响应解析失败: {e}")
+            self.logger.error("响应解析失败: %s", e)
             return {"content": response, "sections": [], "keywords": [], "maps": []}
     
-    def _extract_sections(self, content: str) -> List[str]:
-        """提取章节标题"""
-        sections = []
-        lines = content.split('\n')
-        for line in lines:
-            if line.strip().startswith('#'):
-                sections.append(line.strip())
-        return sections
-    
-    def _extract_keywords(self, content: str) -> List[str]:
-        """提取关键词（加粗内容）"""
-        keywords = re.findall(r'\*\*(.*?)\*\*', content)
-        return list(set(keywords))
-    
-    def _extract_map_suggestions(self, content: str) -> List[str]:
-        """提取地图搜索建议"""
-        maps = re.findall(r'\[(.*?)\] - "(.*?)"', content)
-        return [f"{title}: {keyword}" for title, keyword in maps]
-    
     def _convert_to_markdown(self, notes: Dict) -> str:
         """转换为Markdown格式"""
         return notes.get("content", "")
     
 
+    def notes_file_path(self, output_path: str, video_title: str = "", filename: str = None) -> Path:
+        """计算笔记Markdown文件的保存路径"""
+        # 使用视频标题作为文件名，如果没有提供则使用默认名称
+        if filename is None:
+            if video_title:
+                # 清理文件名中的特殊字符
+                safe_title = _UNSAFE_FILENAME_RE.sub('_', video_title)
+                filename = f"{safe_title}.md"
+            else:
+                filename = "learning_notes.md"
+
+        return Path(output_path) / filename
+
     def save_notes_to_file(self, notes: Dict, output_path: str, video_title: str = "", filename: str = None):
         """保存笔记到文件"""
         try:
+            import orjson
+
             output_dir = Path(output_path)
             output_dir.mkdir(parents=True, exist_ok=True)
-            
-            # 使用视频标题作为文件名，如果没有提供则使用默认名称
-            if filename is None:
-                if video_title:
-                    # 清理文件名中的特殊字符
-                    safe_title = re.sub(r'[<>:"/\\|?*]', '_', video_title)
-                    filename = f"{safe_title}.md"
-                else:
-                    filename = "learning_notes.md"
-            
+
             # 保存Markdown文件
-            markdown_path = output_dir / filename
+            markdown_path = self.notes_file_path(output_path, video_title, filename)
             with open(markdown_path, "w", encoding="utf-8") as f:
                 # 优先使用markdown字段，如果没有则使用json.content，最后使用content
                 markdown_content = notes.get("markdown") or notes.get("json", {}).get("content") or notes.get("content", "")
                 f.write(markdown_content)
             
             # 保存JSON文件（包含元数据）
-            json_path = output_dir / f"{Path(filename).stem}.json"
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(notes, f, ensure_ascii=False, indent=2)
+            # 笔记正文已写入.md文件，这里去掉重复的正文字段，只保留结构化数据
+            notes_meta = {k: v for k, v in notes.items() if k != "markdown"}
+            if isinstance(notes_meta.get("json"), dict):
+                notes_meta["json"] = {k: v for k, v in notes_meta["json"].items() if k != "content"}
+
+            json_path = output_dir / f"{markdown_path.stem}.json"
+            with open(json_path, "wb") as f:
+                f.write(orjson.dumps(notes_meta, option=orjson.OPT_INDENT_2))
             
-            self.logger.info(f"笔记已保存到: {markdown_path}")
+            self.logger.info("笔记已保存到: %s", markdown_path)
             return str(markdown_path)
             
         except Exception as e:
-            self.logger.error(f"笔记保存失败: {e}")
+            self.logger.error("笔记保存失败: %s", e)
             raise
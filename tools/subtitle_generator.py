@@ -3,109 +3,305 @@
 负责将音频转换为字幕文件
 """
 
-import whisper
-import torch
 import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pathlib import Path
-from typing import Dict, List
-import json
-import re
+from typing import Dict, List, Union
+
+# Whisper的输入采样率
+WHISPER_SAMPLE_RATE = 16000
+
+# 基础initial_prompt，确保生成简体中文
+_BASE_INITIAL_PROMPT = "以下是普通话的句子。使用简体中文。"
+
+# 进程级模型缓存，key为(model_size, device)
+# 模型加载需要数秒且占用显存，同规格模型在所有实例间共享
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+def decode_audio(audio_path: str) -> np.ndarray:
+    """
+    用ffmpeg管道将音频解码为16kHz单声道float32数组
+
+    解码结果直接留在内存中交给Whisper，不落盘、不产生临时文件，
+    整条链路只有这一次解码
+
+    Args:
+        audio_path: 音频或视频文件路径
+
+    Returns:
+        np.ndarray: float32波形数据
+    """
+    result = subprocess.run(
+        [
+            "ffmpeg", "-i", audio_path,
+            "-f", "s16le", "-ac", "1", "-ar", str(WHISPER_SAMPLE_RATE),
+            "-loglevel", "quiet",
+            "pipe:1"
+        ],
+        capture_output=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg音频解码失败: {audio_path}")
+
+    # 原地归一化，避免再分配一份完整波形的临时数组
+    audio = np.frombuffer(result.stdout, np.int16).astype(np.float32)
+    audio /= 32768.0
+    return audio
 
 class SubtitleGenerator:
     """字幕生成器"""
-    
-    def __init__(self, model_size: str = "base"):
+
+    def __init__(self, model_size: str = "base", batch_size: int = None, compute_type: str = None,
+                 cache_dir: str = None):
         """
         初始化字幕生成器
-        
+
         Args:
             model_size: Whisper模型大小 (tiny, base, small, medium, large)
+            batch_size: 批量推理的批大小，不指定时按GPU显存自动选择
+            compute_type: CTranslate2计算精度，不指定时GPU用int8_float16、
+                CPU用int8。int8量化大约换来2倍吞吐和一半显存，
+                字错率(WER)损失通常在1%以内；追求最高精度可指定
+                "float16"（GPU）或"float32"（CPU）
+            cache_dir: 转录结果缓存目录，默认~/.cache/video_note_agent/subs
         """
         self.logger = logging.getLogger(__name__)
-        self.model = self._load_model(model_size)
+        self.model = self._load_model(model_size, compute_type)
         self.model_size = model_size
-    
-    def _load_model(self, model_size: str):
-        """加载Whisper模型"""
+        self.batch_size = batch_size if batch_size is not None else self._auto_batch_size()
+        self.cache_dir = Path(cache_dir or "~/.cache/video_note_agent/subs").expanduser()
+        self.logger.info("批量推理batch_size: %d", self.batch_size)
+
+    def _auto_batch_size(self) -> int:
+        """根据GPU总显存自动选择批大小，显存越大批越大"""
         try:
-            # 检查是否有GPU
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            self.logger.info(f"使用设备: {device}")
-            self.logger.info(f"加载Whisper模型: {model_size}")
-            
-            model = whisper.load_model(model_size, device=device)
-            self.logger.info("Whisper模型加载成功")
-            return model
+            import torch
+
+            total_gb = torch.cuda.mem_get_info()[1] / (1 << 30)
+            if total_gb <= 8:
+                return 8
+            if total_gb <= 16:
+                return 16
+            return 32
+        except Exception:
+            # CPU环境或无法检测显存时取保守值
+            return 8
+
+    def _load_model(self, model_size: str, compute_type: str = None):
+        """加载faster-whisper模型并包装为批量推理管线（同规格模型进程内只加载一次）"""
+        try:
+            import ctranslate2
+            from faster_whisper import WhisperModel, BatchedInferencePipeline
+
+            # 检查是否有GPU，按设备选择量化精度
+            device_count = ctranslate2.get_cuda_device_count()
+            if device_count > 0:
+                device = "cuda"
+                compute_type = compute_type or "int8_float16"
+            else:
+                device = "cpu"
+                compute_type = compute_type or "int8"
+
+            self.device = device
+            self.compute_type = compute_type
+            self.num_devices = max(device_count, 1)
+
+            cache_key = (model_size, device, compute_type)
+            with _MODEL_CACHE_LOCK:
+                if cache_key in _MODEL_CACHE:
+                    self.logger.info("复用已加载的Whisper模型: %s (%s)", model_size, device)
+                    return _MODEL_CACHE[cache_key]
+
+                self.logger.info("使用设备: %s, 计算精度: %s", device, compute_type)
+                self.logger.info("加载Whisper模型: %s", model_size)
+
+                if device == "cpu":
+                    # CPU推理：用满物理核心，两个worker交替喂批次
+                    model = WhisperModel(
+                        model_size,
+                        device=device,
+                        compute_type=compute_type,
+                        cpu_threads=os.cpu_count() or 4,
+                        num_workers=2
+                    )
+                elif device_count > 1:
+                    # 多GPU：权重复制到每张卡，并发转录请求分摊到不同设备
+                    self.logger.info("检测到 %d 张GPU，启用多卡分发", device_count)
+                    model = WhisperModel(
+                        model_size,
+                        device=device,
+                        compute_type=compute_type,
+                        device_index=list(range(device_count)),
+                        num_workers=device_count
+                    )
+                else:
+                    model = WhisperModel(model_size, device=device, compute_type=compute_type)
+
+                # 批量推理管线：VAD切分音频块后批量送入编码器
+                pipeline = BatchedInferencePipeline(model)
+                _MODEL_CACHE[cache_key] = pipeline
+                self.logger.info("Whisper模型加载成功")
+                return pipeline
         except Exception as e:
-            self.logger.error(f"模型加载失败: {e}")
+            self.logger.error("模型加载失败: %s", e)
             raise
-    
-    def transcribe_audio(self, audio_path: str, language: str = "zh") -> Dict:
+
+    @classmethod
+    def preload(cls, model_size: str = "base"):
         """
-        转录音频文件，生成带时间戳的字幕
-        
+        进程启动时预热模型，让首次转录不用等待模型加载
+
+        加载后用1秒静音跑一次转录，把VAD模型加载和推理内核的
+        一次性初始化开销也移出首次真实转录
+        """
+        generator = cls(model_size=model_size)
+        generator.transcribe_audio(np.zeros(WHISPER_SAMPLE_RATE, dtype=np.float32))
+        return generator
+
+    def _transcription_cache_path(self, audio_path: str, language: str,
+                                  context_prompt: str = None) -> Path:
+        """计算转录缓存文件路径，key为音频内容哈希+模型大小+语言（+上下文）"""
+        import hashlib
+
+        h = hashlib.sha256()
+        with open(audio_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+
+        key = f"{h.hexdigest()[:32]}_{self.model_size}_{language}"
+        if context_prompt:
+            key += f"_{hashlib.sha256(context_prompt.encode()).hexdigest()[:8]}"
+        return self.cache_dir / f"{key}.json"
+
+    def transcribe_audio(self, audio: Union[str, np.ndarray], language: str = "zh",
+                         use_cache: bool = True, context_prompt: str = None) -> Dict:
+        """
+        转录音频，生成带时间戳的字幕
+
+        同一音频+模型+语言的转录结果在磁盘上按内容哈希缓存，
+        重复转录直接返回缓存结果
+
         Args:
-            audio_path: 音频文件路径
+            audio: 音频文件路径，或已解码的16kHz单声道float32波形数组
             language: 识别语言，默认中文
-            
+            use_cache: 是否使用磁盘缓存（仅对文件路径输入生效）
+            context_prompt: 上一段音频结尾的文本，拼在initial_prompt后
+                用于跨段保持解码上下文（分段转录长音频时使用）
+
         Returns:
             Dict: 包含时间戳的转录结果
         """
         try:
-            self.logger.info(f"开始转录音频: {audio_path}")
-            
-            # 转录选项 - 使用initial_prompt确保生成简体中文
-            options = {
-                "language": "zh",  # 使用中文
-                "task": "transcribe",
-                "word_timestamps": False,  # 获取词级时间戳
-                "verbose": False,
-                "initial_prompt": "以下是普通话的句子。使用简体中文。"  # 确保生成简体中文
-            }
-            
-            # 执行转录
-            result = self.model.transcribe(audio_path, **options)
-            
-            # 处理结果
-            processed_result = self._process_transcription_result(result)
-            
-            self.logger.info(f"音频转录完成，共 {len(processed_result['segments'])} 个段落")
-            return processed_result
-            
-        except Exception as e:
-            self.logger.error(f"音频转录失败: {e}")
-            raise
-    
-    def _process_transcription_result(self, result: Dict) -> Dict:
-        """处理转录结果"""
-        try:
-            # 提取完整文本
-            full_text = result.get("text", "")
-            
-            # 处理段落
+            import orjson
+
+            cache_path = None
+            if isinstance(audio, str):
+                self.logger.info("开始转录音频: %s", audio)
+                if use_cache:
+                    cache_path = self._transcription_cache_path(audio, language, context_prompt)
+                    if cache_path.exists():
+                        self.logger.info("命中转录缓存: %s", cache_path)
+                        return orjson.loads(cache_path.read_bytes())
+            else:
+                self.logger.info("开始转录内存中的音频波形，共 %s 个采样点", len(audio))
+
+            # initial_prompt确保生成简体中文，并附带上一段的结尾文本保持上下文
+            initial_prompt = _BASE_INITIAL_PROMPT
+            if context_prompt:
+                initial_prompt = f"{initial_prompt}{context_prompt}"
+
+            # 执行批量转录 - VAD按静音切分音频块，避免任意切点截断词语
+            segments_iter, info = self.model.transcribe(
+                audio,
+                language="zh",  # 使用中文
+                task="transcribe",
+                batch_size=self.batch_size,
+                beam_size=1,  # 贪心解码，比默认beam=5快且字幕质量几乎无差别
+                vad_filter=True,
+                initial_prompt=initial_prompt
+            )
+
+            # 一次遍历整理为与旧版whisper一致的结果结构，
+            # 同时累计文本和置信度，让统计环节不用再遍历一遍
             segments = []
-            for segment in result.get("segments", []):
-                segment_text = segment.get("text", "")
-                
-                corrected_segment = {
-                    "start": segment.get("start", 0),
-                    "end": segment.get("end", 0),
-                    "text": segment_text,
-                    "confidence": segment.get("confidence", 0)
-                }
-                segments.append(corrected_segment)
-            
-            return {
-                "full_text": full_text,
+            text_parts = []
+            confidence_sum = 0.0
+            for segment in segments_iter:
+                segments.append({
+                    "start": segment.start,
+                    "end": segment.end,
+                    "text": segment.text,
+                    "confidence": segment.avg_logprob
+                })
+                text_parts.append(segment.text)
+                confidence_sum += segment.avg_logprob
+
+            processed_result = {
+                "full_text": "".join(text_parts),
                 "segments": segments,
-                "language": result.get("language", "zh"),
-                "duration": result.get("duration", 0)
+                "language": info.language,
+                "duration": info.duration,
+                "_confidence_sum": confidence_sum
             }
-            
+
+            # 写入缓存：先写临时文件再原子改名，避免中途失败留下半截缓存
+            if cache_path is not None:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_suffix(".tmp")
+                tmp_path.write_bytes(orjson.dumps(processed_result))
+                os.replace(tmp_path, cache_path)
+
+            self.logger.info("音频转录完成，共 %s 个段落", len(processed_result['segments']))
+            return processed_result
+
         except Exception as e:
-            self.logger.error(f"转录结果处理失败: {e}")
+            self.logger.error("音频转录失败: %s", e)
             raise
     
+    def transcribe_many(self, audio_paths: List[str], language: str = "zh"):
+        """
+        顺序转录多个音频文件，解码与推理重叠
+
+        模型在推理当前文件时，后台线程用ffmpeg预解码下一个文件
+        （解码在原生代码中运行，不占GIL），推理拿到的始终是
+        已就绪的波形数组。多GPU环境下，各文件并发提交，
+        由CTranslate2把请求分摊到不同设备上，吞吐随卡数接近线性扩展
+
+        Args:
+            audio_paths: 音频文件路径列表
+            language: 识别语言，默认中文
+
+        Yields:
+            Dict: 每个文件的转录结果，顺序与输入一致
+        """
+        if not audio_paths:
+            return
+
+        if self.num_devices > 1:
+            # 多GPU：并发提交所有文件，每个worker绑定一张卡
+            with ThreadPoolExecutor(max_workers=self.num_devices) as executor:
+                futures = [
+                    executor.submit(self.transcribe_audio, path, language)
+                    for path in audio_paths
+                ]
+                for future in futures:
+                    yield future.result()
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_future = executor.submit(decode_audio, audio_paths[0])
+
+            for index in range(len(audio_paths)):
+                audio = next_future.result()
+                if index + 1 < len(audio_paths):
+                    next_future = executor.submit(decode_audio, audio_paths[index + 1])
+
+                yield self.transcribe_audio(audio, language=language)
 
     def save_subtitle_file(self, transcription: Dict, output_path: str, format_type: str = "srt") -> str:
         """
@@ -121,88 +317,102 @@ class SubtitleGenerator:
         """
         try:
             segments = transcription.get("segments", [])
-            
+
             if format_type == "srt":
-                content = self._format_srt(segments)
+                lines = self._iter_srt(segments)
             elif format_type == "vtt":
-                content = self._format_vtt(segments)
+                lines = self._iter_vtt(segments)
             elif format_type == "txt":
-                content = self._format_txt(segments)
+                lines = self._iter_txt(segments)
             else:
                 raise ValueError(f"不支持的格式类型: {format_type}")
+
+            # 流式写入：逐条写进1MB写缓冲，不在内存中拼接完整内容
+            with open(output_path, "w", encoding="utf-8", buffering=1 << 20) as f:
+                f.writelines(lines)
             
-            # 保存文件
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(content)
-            
-            self.logger.info(f"字幕文件已保存: {output_path}")
+            self.logger.info("字幕文件已保存: %s", output_path)
             return output_path
             
         except Exception as e:
-            self.logger.error(f"字幕文件保存失败: {e}")
+            self.logger.error("字幕文件保存失败: %s", e)
             raise
     
-    def _format_srt(self, segments: List[Dict]) -> str:
-        """格式化为SRT格式"""
-        srt_content = []
-        for i, segment in enumerate(segments, 1):
-            start_time = self._format_time(segment["start"])
-            end_time = self._format_time(segment["end"])
-            text = segment["text"].strip()
-            
-            srt_content.append(f"{i}\n{start_time} --> {end_time}\n{text}\n")
-        
-        return "\n".join(srt_content)
-    
-    def _format_vtt(self, segments: List[Dict]) -> str:
-        """格式化为VTT格式"""
-        vtt_content = ["WEBVTT\n"]
-        
-        for segment in segments:
-            start_time = self._format_time_vtt(segment["start"])
-            end_time = self._format_time_vtt(segment["end"])
-            text = segment["text"].strip()
-            
-            vtt_content.append(f"{start_time} --> {end_time}\n{text}\n")
-        
-        return "\n".join(vtt_content)
-    
-    def _format_txt(self, segments: List[Dict]) -> str:
-        """格式化为纯文本格式"""
-        txt_content = []
-        for segment in segments:
-            timestamp = self._format_time(segment["start"])
-            text = segment["text"].strip()
-            txt_content.append(f"[{timestamp}] {text}")
-        
-        return "\n".join(txt_content)
-    
-    def _format_time(self, seconds: float) -> str:
-        """格式化时间为SRT格式"""
-        hours = int(seconds // 3600)
-        minutes = int((seconds % 3600) // 60)
-        secs = int(seconds % 60)
-        millisecs = int((seconds % 1) * 1000)
-        
-        return f"{hours:02d}:{minutes:02d}:{secs:02d},{millisecs:03d}"
+    @staticmethod
+    def _format_timestamps(values: List[float], sep: str) -> List[str]:
+        """
+        批量格式化时间戳为HH:MM:SS{sep}mmm
+
+        用NumPy一次算完所有段落的时分秒毫秒，替代逐段的Python除法
+        """
+        total_ms = (np.asarray(values, dtype=np.float64) * 1000).astype(np.int64)
+        secs, ms = np.divmod(total_ms, 1000)
+        mins, secs = np.divmod(secs, 60)
+        hours, mins = np.divmod(mins, 60)
+
+        return [
+            f"{h:02d}:{m:02d}:{s:02d}{sep}{milli:03d}"
+            for h, m, s, milli in zip(hours.tolist(), mins.tolist(), secs.tolist(), ms.tolist())
+        ]
+
+    def _iter_srt(self, segments: List[Dict]):
+        """逐条生成SRT格式的字幕条目"""
+        start_times = self._format_timestamps([s["start"] for s in segments], ",")
+        end_times = self._format_timestamps([s["end"] for s in segments], ",")
+
+        for i, (segment, start_time, end_time) in enumerate(zip(segments, start_times, end_times), 1):
+            prefix = "" if i == 1 else "\n"
+            yield f"{prefix}{i}\n{start_time} --> {end_time}\n{segment['text'].strip()}\n"
+
+    def _iter_vtt(self, segments: List[Dict]):
+        """逐条生成VTT格式的字幕条目"""
+        start_times = self._format_timestamps([s["start"] for s in segments], ".")
+        end_times = self._format_timestamps([s["end"] for s in segments], ".")
+
+        yield "WEBVTT\n"
+        for segment, start_time, end_time in zip(segments, start_times, end_times):
+            yield f"\n{start_time} --> {end_time}\n{segment['text'].strip()}\n"
+
+    def _iter_txt(self, segments: List[Dict]):
+        """逐条生成带时间戳的纯文本行"""
+        timestamps = self._format_timestamps([s["start"] for s in segments], ",")
+
+        for i, (segment, timestamp) in enumerate(zip(segments, timestamps)):
+            prefix = "" if i == 0 else "\n"
+            yield f"{prefix}[{timestamp}] {segment['text'].strip()}"
     
-    def _format_time_vtt(self, seconds: float) -> str:
-        """格式化时间为VTT格式"""
-        hours = int(seconds // 3600)
-        minutes = int((seconds % 3600) // 60)
-        secs = int(seconds % 60)
-        millisecs = int((seconds % 1) * 1000)
-        
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}.{millisecs:03d}"
+    @staticmethod
+    def _format_time(seconds: float, sep: str = ",") -> str:
+        """格式化单个时间戳为HH:MM:SS{sep}mmm（SRT用","，VTT用"."）"""
+        # 一次换算成毫秒后连续divmod，两次除法替代原先的四次
+        secs, ms = divmod(int(seconds * 1000), 1000)
+        mins, secs = divmod(secs, 60)
+        hours, mins = divmod(mins, 60)
+
+        return f"{hours:02d}:{mins:02d}:{secs:02d}{sep}{ms:03d}"
     
     def get_transcription_stats(self, transcription: Dict) -> Dict:
         """获取转录统计信息"""
         segments = transcription.get("segments", [])
         full_text = transcription.get("full_text", "")
-        
+
+        # 优先使用处理阶段累计好的置信度总和（O(1)），
+        # 没有时退回numpy列均值
+        if not segments:
+            average_confidence = 0
+        elif "_confidence_sum" in transcription:
+            average_confidence = transcription["_confidence_sum"] / len(segments)
+        else:
+            confidences = np.fromiter(
+                (s.get("confidence", 0) for s in segments),
+                dtype=np.float64,
+                count=len(segments)
+            )
+            average_confidence = float(confidences.mean())
+
         return {
             "total_segments": len(segments),
             "total_text_length": len(full_text),
-            "average_confidence": sum(s.get("confidence", 0) for s in segments) / len(segments) if segments else 0,
+            "average_confidence": average_confidence,
             "duration": transcription.get("duration", 0)
         }